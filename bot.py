@@ -1,10 +1,13 @@
 import os
+import re
 import logging
 import asyncio
 import sys
+import time
 from datetime import datetime
 from typing import List, Dict, Optional
 import json
+import hashlib
 import threading
 import atexit
 from dotenv import load_dotenv
@@ -13,19 +16,19 @@ from telegram import (
     Update, 
     InlineKeyboardButton, 
     InlineKeyboardMarkup,
-    BotCommand
+    BotCommand,
+    BotCommandScopeChat,
+    BotCommandScopeDefault
 )
 from telegram.ext import (
     Application,
     CommandHandler,
     CallbackQueryHandler,
-    MessageHandler,
-    ContextTypes,
-    filters
+    ContextTypes
 )
-from telegram.constants import ParseMode
+from telegram.constants import ChatMemberStatus, MessageLimit, ParseMode
 import pymongo
-from pymongo import MongoClient, errors
+from pymongo import MongoClient, UpdateOne, errors
 from concurrent.futures import ThreadPoolExecutor
 
 # Load environment variables
@@ -40,7 +43,7 @@ logger = logging.getLogger(__name__)
 
 # Configuration
 BOT_TOKEN = os.getenv('BOT_TOKEN')
-ADMIN_IDS = list(map(int, os.getenv('ADMIN_IDS', '').split(','))) if os.getenv('ADMIN_IDS') else []
+ADMIN_IDS = frozenset(int(x) for x in os.getenv('ADMIN_IDS', '').split(',') if x.strip())
 PORT = int(os.getenv('PORT', 8080))
 MONGODB_URI = os.getenv('MONGODB_URI', 'mongodb://localhost:27017/')
 
@@ -52,6 +55,104 @@ if INITIAL_CHANNELS_ENV:
 else:
     INITIAL_CHANNELS = []
 
+# Member statuses that mean the user is not in the channel
+NOT_MEMBER_STATUSES = frozenset({ChatMemberStatus.LEFT, ChatMemberStatus.BANNED})
+
+# Referral codes are always "REF<user_id>" - reject anything else before any lookup
+REFERRAL_CODE_RE = re.compile(r'REF\d+')
+
+# Callback data prefix for broadcast confirmation buttons
+BROADCAST_CONFIRM_PREFIX = "admin_broadcast_confirm_"
+# Messages sent per second during a broadcast (Telegram allows about 30/s overall)
+BROADCAST_BATCH_SIZE = 25
+
+# Leave some headroom below Telegram's 4096 character limit per message
+MESSAGE_CHUNK_SIZE = MessageLimit.MAX_TEXT_LENGTH - 96
+
+# Static message texts
+HELP_TEXT = (
+    "Bot Help\n\n"
+    "Available Commands:\n"
+    "/start - Start the bot\n"
+    "/withdraw <amount> <method> - Withdraw money\n"
+    "/help - Show this help\n\n"
+    "How to Earn:\n"
+    "1. Get ₹1 welcome bonus after joining all channels\n"
+    "2. Share your referral link\n"
+    "3. Earn ₹1.00 when someone joins via your link AND completes all channel joins\n"
+    "4. Minimum withdrawal: ₹10.00\n\n"
+    "Note: Referral bonuses are credited after users join all required channels!"
+)
+WITHDRAW_USAGE_TEXT = (
+    "Withdrawal Request\n\n"
+    "Usage: /withdraw <amount> <method>\n"
+    "Example: /withdraw 50 upi\n\n"
+    "Available methods: UPI, Bank Transfer\n"
+    "Minimum withdrawal: ₹10.00"
+)
+RESTART_OPTIONS_TEXT = (
+    "Restart Options\n\n"
+    "Soft Restart: Reload data without stopping bot"
+)
+# Admin panel text - only the stats block changes between calls
+ADMIN_PANEL_TEXT = (
+    "👑 Admin Panel\n\n"
+    "{stats}\n\n"
+    "Commands:\n"
+    "/listchannels - View channels (read-only)\n"
+    "/broadcast <message> - Broadcast\n"
+    "/restart - Restart options\n"
+    "/backup - Backup data\n"
+    "/stats - Show statistics\n\n"
+    "Channel Configuration:\n"
+    "Channels are configured via INITIAL_CHANNELS environment variable."
+)
+
+# Static keyboards - built once and reused (telegram objects are immutable)
+BACK_TO_MAIN_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔙 Back", callback_data="back_to_main")]
+])
+BACK_TO_ADMIN_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔙 Back", callback_data="admin_panel")]
+])
+BALANCE_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📤 Withdraw", callback_data="withdraw"),
+     InlineKeyboardButton("🔙 Back", callback_data="back_to_main")]
+])
+WITHDRAW_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("💰 Check Balance", callback_data="balance"),
+     InlineKeyboardButton("🔙 Back", callback_data="back_to_main")]
+])
+REFERRALS_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔗 Share Link", callback_data="invite_link")],
+    [InlineKeyboardButton("🔙 Back", callback_data="back_to_main")]
+])
+_MAIN_MENU_ROWS = [
+    [InlineKeyboardButton("💰 Balance", callback_data="balance"),
+     InlineKeyboardButton("📤 Withdraw", callback_data="withdraw")],
+    [InlineKeyboardButton("📜 History", callback_data="history"),
+     InlineKeyboardButton("👥 Referrals", callback_data="referrals")],
+    [InlineKeyboardButton("🔗 Invite Link", callback_data="invite_link")]
+]
+_REFRESH_ROW = [InlineKeyboardButton("🔄 Refresh", callback_data="refresh")]
+MAIN_MENU_KB = InlineKeyboardMarkup(_MAIN_MENU_ROWS + [_REFRESH_ROW])
+MAIN_MENU_ADMIN_KB = InlineKeyboardMarkup(
+    _MAIN_MENU_ROWS
+    + [[InlineKeyboardButton("👑 Admin Panel", callback_data="admin_panel")]]
+    + [_REFRESH_ROW]
+)
+ADMIN_PANEL_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📢 View Channels", callback_data="admin_channels")],
+    [InlineKeyboardButton("📊 Stats", callback_data="admin_stats")],
+    [InlineKeyboardButton("💾 Backup", callback_data="admin_backup")],
+    [InlineKeyboardButton("🔄 Restart", callback_data="admin_restart")],
+    [InlineKeyboardButton("🔙 Back", callback_data="back_to_main")]
+])
+ADMIN_RESTART_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔄 Soft Restart", callback_data="admin_restart_soft"),
+     InlineKeyboardButton("🔙 Cancel", callback_data="admin_panel")]
+])
+
 logger.info(f"📢 Initial channels from env: {INITIAL_CHANNELS}")
 logger.info(f"🌐 MongoDB URI configured: {bool(MONGODB_URI)}")
 
@@ -62,9 +163,64 @@ users_collection = None
 referrals_collection = None
 pending_referrals_collection = None  # NEW: For tracking pending referrals
 
+class TTLCache:
+    """Small in-process cache with per-entry expiry and a size bound"""
+    
+    def __init__(self, ttl: float, max_size: int = 10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._data: Dict = {}
+    
+    def get(self, key, default=None):
+        """Return cached value, or default if missing or expired"""
+        entry = self._data.get(key)
+        if entry and time.monotonic() - entry[0] < self.ttl:
+            return entry[1]
+        return default
+    
+    def set(self, key, value):
+        """Store value, pruning expired entries when the cache is full"""
+        now = time.monotonic()
+        if len(self._data) >= self.max_size:
+            for k in [k for k, v in self._data.items() if now - v[0] >= self.ttl]:
+                del self._data[k]
+            if len(self._data) >= self.max_size:
+                self._data.clear()
+        self._data[key] = (now, value)
+    
+    def clear(self):
+        """Drop all entries"""
+        self._data.clear()
+
+# Sentinel for cache misses where None is a valid cached value
+CACHE_MISS = object()
+
+# Short-lived cache of pending referral lookups: referred_id -> referrer_id or None
+pending_referrer_cache = TTLCache(ttl=30)
+
+# Users who passed the membership check - skips the get_chat_member fan-out on repeat checks
+joined_cache = TTLCache(ttl=300)
+
+# Per-user throttle for the Verify Join button
+VERIFY_THROTTLE_SECONDS = 3
+verify_throttle_cache = TTLCache(ttl=VERIFY_THROTTLE_SECONDS)
+
+# Admin statistics text
+stats_cache = TTLCache(ttl=30, max_size=1)
+
+# Invite links per chat - export_invite_link revokes the previous link, so reuse it
+invite_link_cache = TTLCache(ttl=3600, max_size=1000)
+
+# Max operations per MongoDB bulk_write call
+BULK_WRITE_BATCH_SIZE = 1000
+
 # Thread pool for blocking operations
 executor = ThreadPoolExecutor(max_workers=10)
 
+async def run_blocking(func, *args):
+    """Run a blocking storage call on the shared thread pool so the event loop keeps serving updates"""
+    return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
 def init_database():
     """Initialize MongoDB connection"""
     global mongo_client, channels_collection, users_collection, referrals_collection, pending_referrals_collection
@@ -135,8 +291,9 @@ def init_database():
         logger.warning("📁 Using file-based storage as fallback")
         return False
 
-# Initialize database
-db_connected = init_database()
+# Database connection state - initialized in main(). True only when every
+# collection is set up, so Storage checks this flag instead of each collection.
+db_connected = False
 
 class Storage:
     """Storage manager with MongoDB and file fallback"""
@@ -145,8 +302,7 @@ class Storage:
     async def save_channels(channels: List[Dict]):
         """Save channels to storage asynchronously"""
         try:
-            loop = asyncio.get_event_loop()
-            await loop.run_in_executor(executor, Storage._save_channels_sync, channels)
+            await run_blocking(Storage._save_channels_sync, channels)
         except Exception as e:
             logger.error(f"Error saving channels: {e}")
     
@@ -154,7 +310,7 @@ class Storage:
     def _save_channels_sync(channels: List[Dict]):
         """Synchronous save channels"""
         try:
-            if mongo_client is not None and channels_collection is not None:
+            if db_connected:
                 # Clear and insert all channels
                 channels_collection.delete_many({})
                 if channels:
@@ -170,8 +326,7 @@ class Storage:
     async def load_channels() -> List[Dict]:
         """Load channels from storage asynchronously"""
         try:
-            loop = asyncio.get_event_loop()
-            return await loop.run_in_executor(executor, Storage._load_channels_sync)
+            return await run_blocking(Storage._load_channels_sync)
         except Exception as e:
             logger.error(f"Error loading channels: {e}")
             return []
@@ -180,7 +335,7 @@ class Storage:
     def _load_channels_sync() -> List[Dict]:
         """Synchronous load channels"""
         try:
-            if mongo_client is not None and channels_collection is not None:
+            if db_connected:
                 # Load from MongoDB
                 channels = list(channels_collection.find({}, {'_id': 0}))
                 return channels
@@ -195,39 +350,40 @@ class Storage:
             return []
     
     @staticmethod
-    async def save_users(users: Dict):
-        """Save users to storage asynchronously"""
+    async def save_users(users: Dict) -> bool:
+        """Save users to storage asynchronously - returns True on success"""
         try:
-            loop = asyncio.get_event_loop()
-            await loop.run_in_executor(executor, Storage._save_users_sync, users)
+            return await run_blocking(Storage._save_users_sync, users)
         except Exception as e:
             logger.error(f"Error saving users: {e}")
+            return False
     
     @staticmethod
-    def _save_users_sync(users: Dict):
-        """Synchronous save users"""
+    def _save_users_sync(users: Dict) -> bool:
+        """Synchronous save users - returns True on success"""
         try:
-            if mongo_client is not None and users_collection is not None:
-                # Update or insert each user
-                for user_id, user_data in users.items():
-                    users_collection.update_one(
-                        {'user_id': int(user_id)},
-                        {'$set': user_data},
-                        upsert=True
-                    )
+            if db_connected:
+                # Upsert all users in batched bulk writes instead of one round-trip per user
+                operations = [
+                    UpdateOne({'user_id': int(user_id)}, {'$set': user_data}, upsert=True)
+                    for user_id, user_data in users.items()
+                ]
+                for i in range(0, len(operations), BULK_WRITE_BATCH_SIZE):
+                    users_collection.bulk_write(operations[i:i + BULK_WRITE_BATCH_SIZE], ordered=False)
             else:
                 # Fallback to file
                 with open('users_backup.json', 'w') as f:
                     json.dump(users, f, default=str)
+            return True
         except Exception as e:
             logger.error(f"Error in sync save_users: {e}")
+            return False
     
     @staticmethod
     async def load_users() -> Dict:
         """Load users from storage asynchronously"""
         try:
-            loop = asyncio.get_event_loop()
-            return await loop.run_in_executor(executor, Storage._load_users_sync)
+            return await run_blocking(Storage._load_users_sync)
         except Exception as e:
             logger.error(f"Error loading users: {e}")
             return {}
@@ -236,16 +392,15 @@ class Storage:
     def _load_users_sync() -> Dict:
         """Synchronous load users"""
         try:
-            if mongo_client is not None and users_collection is not None:
+            if db_connected:
                 # Load from MongoDB
                 users = {}
-                cursor = users_collection.find({})
+                # Exclude MongoDB _id field on the server
+                cursor = users_collection.find({}, {'_id': 0})
                 for user in cursor:
                     user_id = user.get('user_id')
                     if user_id:
-                        # Remove MongoDB _id field
-                        user_dict = {k: v for k, v in user.items() if k != '_id'}
-                        users[str(user_id)] = user_dict
+                        users[str(user_id)] = user
                 return users
             else:
                 # Fallback from file
@@ -258,27 +413,28 @@ class Storage:
             return {}
     
     @staticmethod
-    async def save_referrals(referrals: Dict):
-        """Save referrals to storage asynchronously"""
+    async def save_referrals(referrals: Dict) -> bool:
+        """Save referrals to storage asynchronously - returns True on success"""
         try:
-            loop = asyncio.get_event_loop()
-            await loop.run_in_executor(executor, Storage._save_referrals_sync, referrals)
+            return await run_blocking(Storage._save_referrals_sync, referrals)
         except Exception as e:
             logger.error(f"Error saving referrals: {e}")
+            return False
     
     @staticmethod
-    def _save_referrals_sync(referrals: Dict):
-        """Synchronous save referrals"""
+    def _save_referrals_sync(referrals: Dict) -> bool:
+        """Synchronous save referrals - returns True on success"""
         try:
-            if mongo_client is not None and referrals_collection is not None:
+            if db_connected:
                 # Clear and insert all referrals
                 referrals_collection.delete_many({})
+                now = datetime.now()
                 referrals_list = []
                 for referred_id, referrer_id in referrals.items():
                     referrals_list.append({
                         'referred_id': int(referred_id),
                         'referrer_id': int(referrer_id),
-                        'created_at': datetime.now()
+                        'created_at': now
                     })
                 if referrals_list:
                     referrals_collection.insert_many(referrals_list)
@@ -286,15 +442,43 @@ class Storage:
                 # Fallback to file
                 with open('referrals_backup.json', 'w') as f:
                     json.dump(referrals, f, default=str)
+            return True
         except Exception as e:
             logger.error(f"Error in sync save_referrals: {e}")
+            return False
+    
+    @staticmethod
+    async def insert_referrals(referrals: Dict) -> bool:
+        """Insert new referrals asynchronously (MongoDB only) - returns True on success"""
+        try:
+            return await run_blocking(Storage._insert_referrals_sync, referrals)
+        except Exception as e:
+            logger.error(f"Error inserting referrals: {e}")
+            return False
+    
+    @staticmethod
+    def _insert_referrals_sync(referrals: Dict) -> bool:
+        """Synchronous insert of new referrals - already recorded ones are skipped"""
+        now = datetime.now()
+        referrals_list = [
+            {'referred_id': int(referred_id), 'referrer_id': int(referrer_id), 'created_at': now}
+            for referred_id, referrer_id in referrals.items()
+        ]
+        try:
+            referrals_collection.insert_many(referrals_list, ordered=False)
+        except errors.BulkWriteError as e:
+            # Duplicate key (11000) means the referral is already stored
+            other_errors = [err for err in e.details.get('writeErrors', []) if err.get('code') != 11000]
+            if other_errors:
+                logger.error(f"Error in sync insert_referrals: {other_errors}")
+                return False
+        return True
     
     @staticmethod
     async def load_referrals() -> Dict:
         """Load referrals from storage asynchronously"""
         try:
-            loop = asyncio.get_event_loop()
-            return await loop.run_in_executor(executor, Storage._load_referrals_sync)
+            return await run_blocking(Storage._load_referrals_sync)
         except Exception as e:
             logger.error(f"Error loading referrals: {e}")
             return {}
@@ -303,10 +487,10 @@ class Storage:
     def _load_referrals_sync() -> Dict:
         """Synchronous load referrals"""
         try:
-            if mongo_client is not None and referrals_collection is not None:
+            if db_connected:
                 # Load from MongoDB
                 referrals = {}
-                cursor = referrals_collection.find({})
+                cursor = referrals_collection.find({}, {'_id': 0, 'referred_id': 1, 'referrer_id': 1})
                 for ref in cursor:
                     referred_id = ref.get('referred_id')
                     referrer_id = ref.get('referrer_id')
@@ -325,46 +509,51 @@ class Storage:
     
     # NEW: Pending referrals storage methods
     @staticmethod
-    async def save_pending_referral(referrer_id: int, referred_id: int):
-        """Save pending referral asynchronously"""
+    async def save_pending_referral(referrer_id: int, referred_id: int) -> bool:
+        """Save pending referral asynchronously - returns False if one already exists"""
         try:
-            loop = asyncio.get_event_loop()
-            await loop.run_in_executor(executor, Storage._save_pending_referral_sync, referrer_id, referred_id)
+            return await run_blocking(Storage._save_pending_referral_sync, referrer_id, referred_id)
         except Exception as e:
             logger.error(f"Error saving pending referral: {e}")
+            return False
     
     @staticmethod
-    def _save_pending_referral_sync(referrer_id: int, referred_id: int):
-        """Synchronous save pending referral"""
+    def _save_pending_referral_sync(referrer_id: int, referred_id: int) -> bool:
+        """Synchronous save pending referral - keeps an existing one untouched"""
         try:
-            if mongo_client is not None and pending_referrals_collection is not None:
-                pending_referrals_collection.update_one(
+            if db_connected:
+                # Single upsert that only writes when no pending referral exists
+                result = pending_referrals_collection.update_one(
                     {'referred_id': referred_id},
-                    {'$set': {
+                    {'$setOnInsert': {
                         'referrer_id': referrer_id,
                         'referred_id': referred_id,
                         'created_at': datetime.now()
                     }},
                     upsert=True
                 )
+                return result.upserted_id is not None
             else:
                 # Fallback to file
                 pending_referrals = {}
                 if os.path.exists('pending_referrals_backup.json'):
                     with open('pending_referrals_backup.json', 'r') as f:
                         pending_referrals = json.load(f)
+                if str(referred_id) in pending_referrals:
+                    return False
                 pending_referrals[str(referred_id)] = referrer_id
                 with open('pending_referrals_backup.json', 'w') as f:
                     json.dump(pending_referrals, f, default=str)
+                return True
         except Exception as e:
             logger.error(f"Error in sync save_pending_referral: {e}")
+            return False
     
     @staticmethod
     async def remove_pending_referral(referred_id: int):
         """Remove pending referral asynchronously"""
         try:
-            loop = asyncio.get_event_loop()
-            await loop.run_in_executor(executor, Storage._remove_pending_referral_sync, referred_id)
+            await run_blocking(Storage._remove_pending_referral_sync, referred_id)
         except Exception as e:
             logger.error(f"Error removing pending referral: {e}")
     
@@ -372,7 +561,7 @@ class Storage:
     def _remove_pending_referral_sync(referred_id: int):
         """Synchronous remove pending referral"""
         try:
-            if mongo_client is not None and pending_referrals_collection is not None:
+            if db_connected:
                 pending_referrals_collection.delete_one({'referred_id': referred_id})
             else:
                 # Fallback to file
@@ -390,8 +579,7 @@ class Storage:
     async def get_pending_referrer(referred_id: int) -> Optional[int]:
         """Get pending referrer ID asynchronously"""
         try:
-            loop = asyncio.get_event_loop()
-            return await loop.run_in_executor(executor, Storage._get_pending_referrer_sync, referred_id)
+            return await run_blocking(Storage._get_pending_referrer_sync, referred_id)
         except Exception as e:
             logger.error(f"Error getting pending referrer: {e}")
             return None
@@ -400,8 +588,11 @@ class Storage:
     def _get_pending_referrer_sync(referred_id: int) -> Optional[int]:
         """Synchronous get pending referrer ID"""
         try:
-            if mongo_client is not None and pending_referrals_collection is not None:
-                pending = pending_referrals_collection.find_one({'referred_id': referred_id})
+            if db_connected:
+                pending = pending_referrals_collection.find_one(
+                    {'referred_id': referred_id},
+                    {'_id': 0, 'referrer_id': 1}
+                )
                 if pending:
                     return pending.get('referrer_id')
                 return None
@@ -423,7 +614,11 @@ class DataManager:
         self.channels = []
         self.users = {}
         self.referrals = {}
+        self.referral_codes = {}  # referral_code -> user id string
         self._lock = threading.Lock()  # Use threading lock for sync operations
+        self._alock = asyncio.Lock()  # Serializes coroutines before they wait on _lock
+        self._dirty_users = set()  # User ids changed since the last flush
+        self._new_referrals = set()  # Referred user ids added since the last flush
         
         # Load data synchronously during initialization
         self._load_all_data_sync()
@@ -438,10 +633,36 @@ class DataManager:
         """Load all data from storage synchronously"""
         logger.info("📂 Loading data from storage...")
         with self._lock:
-            self.users = Storage._load_users_sync()
-            self.referrals = Storage._load_referrals_sync()
+            self._set_loaded_data(Storage._load_users_sync(), Storage._load_referrals_sync())
         logger.info(f"✅ Loaded {len(self.users)} users, {len(self.referrals)} referrals")
     
+    def _set_loaded_data(self, users: Dict, referrals: Dict):
+        """Swap in freshly loaded data (call while holding the lock)"""
+        self.users = users
+        self.referrals = referrals
+        self.referral_codes = {
+            u['referral_code']: user_str
+            for user_str, u in users.items() if u.get('referral_code')
+        }
+    
+    async def reload_all_data_async(self) -> bool:
+        """Reload all data from storage without blocking the event loop
+        
+        Returns False if pending changes could not be written first."""
+        logger.info("📂 Reloading data from storage...")
+        # Hold the lock across flush, load and swap so no change lands in between
+        async with self._async_lock():
+            await self._flush_dirty_locked()
+            if self._dirty_users or self._new_referrals:
+                logger.error("Reload skipped - pending changes could not be saved")
+                return False
+            users = await Storage.load_users()
+            referrals = await Storage.load_referrals()
+            self._set_loaded_data(users, referrals)
+        stats_cache.clear()  # Don't show pre-reload numbers
+        logger.info(f"✅ Reloaded {len(self.users)} users, {len(self.referrals)} referrals")
+        return True
+    
     def init_channels_from_env(self):
         """Initialize channels from environment variable"""
         if INITIAL_CHANNELS:
@@ -525,36 +746,90 @@ class DataManager:
             Storage._save_referrals_sync(self.referrals)
         logger.info(f"✅ Data backed up: {len(self.channels)} channels, {len(self.users)} users, {len(self.referrals)} referrals")
     
+    def mark_user_dirty(self, user_str: str):
+        """Queue a user for the next flush (call while holding the lock)"""
+        self._dirty_users.add(user_str)
+    
+    def mark_referral_added(self, referred_str: str):
+        """Queue a new referral for the next flush (call while holding the lock)"""
+        self._new_referrals.add(referred_str)
+    
+    async def flush_dirty_data(self):
+        """Persist only the users/referrals changed since the last flush"""
+        # Unlocked peek - an id added right after this check is picked up by the next flush
+        if not (self._dirty_users or self._new_referrals):
+            return
+        async with self._async_lock():
+            await self._flush_dirty_locked()
+    
+    async def _flush_dirty_locked(self):
+        """Write pending user/referral changes (call while holding the lock)"""
+        # Ids are only dropped from the dirty sets once their save succeeded,
+        # so a failed write is retried on the next flush
+        if self._dirty_users:
+            if db_connected:
+                # MongoDB upserts per user, so only send the changed ones
+                users = {u: self.users[u] for u in self._dirty_users if u in self.users}
+            else:
+                # File fallback rewrites the whole file
+                users = self.users
+            if await Storage.save_users(users):
+                self._dirty_users = set()
+        if self._new_referrals:
+            if db_connected:
+                # Insert just the new referrals; the unique index rejects duplicates
+                saved = await Storage.insert_referrals({r: self.referrals[r] for r in self._new_referrals})
+            else:
+                # File fallback rewrites the whole file
+                saved = await Storage.save_referrals(self.referrals)
+            if saved:
+                self._new_referrals = set()
+    
     async def backup_all_data_async(self):
         """Backup all data to storage asynchronously"""
         logger.info("💾 Backing up data to storage (async)...")
         async with self._async_lock():
             await Storage.save_channels(self.channels)
-            await Storage.save_users(self.users)
-            await Storage.save_referrals(self.referrals)
+            # A full save covers every pending change - keep them queued if it failed
+            if await Storage.save_users(self.users):
+                self._dirty_users = set()
+            if await Storage.save_referrals(self.referrals):
+                self._new_referrals = set()
         logger.info(f"✅ Data backed up (async): {len(self.channels)} channels, {len(self.users)} users, {len(self.referrals)} referrals")
     
     def _async_lock(self):
         """Create async lock for async operations"""
         class AsyncLock:
-            def __init__(self, lock):
+            def __init__(self, lock, alock):
                 self._lock = lock
+                self._alock = alock
             
             async def __aenter__(self):
-                loop = asyncio.get_event_loop()
-                await loop.run_in_executor(executor, self._lock.acquire)
+                # Only one coroutine at a time may block an executor thread on the
+                # threading lock, so concurrent updates can't exhaust the pool
+                await self._alock.acquire()
+                try:
+                    await run_blocking(self._lock.acquire)
+                except BaseException:
+                    self._alock.release()
+                    raise
                 return self
             
             async def __aexit__(self, exc_type, exc, tb):
-                loop = asyncio.get_event_loop()
-                await loop.run_in_executor(executor, self._lock.release)
+                self._lock.release()
+                self._alock.release()
         
-        return AsyncLock(self._lock)
+        return AsyncLock(self._lock, self._alock)
     
     def get_stats(self) -> str:
         """Get data statistics - HTML format to avoid Markdown parsing issues"""
+        # Summing balances walks every user, so reuse the result for a short while
+        stats = stats_cache.get('stats')
+        if stats is not None:
+            return stats
+        
         total_balance = sum(u.get('balance', 0) for u in self.users.values())
-        return (
+        stats = (
             f"📊 <b>Database Statistics:</b>\n\n"
             f"📢 <b>Channels:</b> {len(self.channels)}\n"
             f"👥 <b>Users:</b> {len(self.users)}\n"
@@ -562,9 +837,11 @@ class DataManager:
             f"💰 <b>Total Balance:</b> ₹{total_balance:.2f}\n"
             f"💾 <b>Storage:</b> {'✅ MongoDB' if db_connected else '📁 Local files'}"
         )
+        stats_cache.set('stats', stats)
+        return stats
 
-# Global data manager
-data_manager = DataManager()
+# Global data manager - created in main() so importing the module has no side effects
+data_manager: Optional[DataManager] = None
 
 class ChannelManager:
     """Manage channels - Read-only from environment"""
@@ -581,11 +858,17 @@ class UserManager:
         """Get user data asynchronously"""
         user_str = str(user_id)
         
+        # Fast path: existing users are served from memory without taking the lock
+        user_data = data_manager.users.get(user_str)
+        if user_data is not None:
+            return user_data
+        
         async with data_manager._async_lock():
             if user_str in data_manager.users:
                 return data_manager.users[user_str]
             
             # Create new user
+            now = datetime.now().isoformat()
             user_data = {
                 'user_id': user_id,
                 'balance': 0.0,
@@ -593,15 +876,16 @@ class UserManager:
                 'referral_count': 0,
                 'total_earned': 0.0,
                 'total_withdrawn': 0.0,
-                'joined_at': datetime.now().isoformat(),
-                'last_active': datetime.now().isoformat(),
+                'joined_at': now,
+                'last_active': now,
                 'transactions': [],
                 'has_joined_channels': False,
                 'welcome_bonus_received': False  # Track if user received welcome bonus
             }
             
             data_manager.users[user_str] = user_data
-            await Storage.save_users(data_manager.users)
+            data_manager.referral_codes[user_data['referral_code']] = user_str
+            data_manager.mark_user_dirty(user_str)
             return user_data
     
     @staticmethod
@@ -612,7 +896,45 @@ class UserManager:
             if user_str in data_manager.users:
                 data_manager.users[user_str].update(updates)
                 data_manager.users[user_str]['last_active'] = datetime.now().isoformat()
-                await Storage.save_users(data_manager.users)
+                data_manager.mark_user_dirty(user_str)
+    
+    @staticmethod
+    async def add_balance(user_id: int, amount: float, increments: Dict = None, updates: Dict = None) -> Dict:
+        """Atomically credit balance and total_earned (plus optional counters/fields)"""
+        user_str = str(user_id)
+        user = await UserManager.get_user(user_id)
+        
+        async with data_manager._async_lock():
+            # Re-read under the lock - a reload may have replaced the user dict meanwhile
+            user = data_manager.users.setdefault(user_str, user)
+            user['balance'] = user.get('balance', 0) + amount
+            user['total_earned'] = user.get('total_earned', 0) + amount
+            for key, value in (increments or {}).items():
+                user[key] = user.get(key, 0) + value
+            if updates:
+                user.update(updates)
+            user['last_active'] = datetime.now().isoformat()
+            data_manager.mark_user_dirty(user_str)
+            return user
+    
+    @staticmethod
+    async def withdraw_balance(user_id: int, amount: float) -> Optional[float]:
+        """Atomically deduct a withdrawal - returns new balance, or None if insufficient"""
+        user_str = str(user_id)
+        user = await UserManager.get_user(user_id)
+        
+        async with data_manager._async_lock():
+            # Re-read under the lock - a reload may have replaced the user dict meanwhile
+            user = data_manager.users.setdefault(user_str, user)
+            balance = user.get('balance', 0)
+            if balance < amount:
+                return None
+            
+            user['balance'] = balance - amount
+            user['total_withdrawn'] = user.get('total_withdrawn', 0) + amount
+            user['last_active'] = datetime.now().isoformat()
+            data_manager.mark_user_dirty(user_str)
+            return user['balance']
     
     @staticmethod
     async def add_transaction(user_id: int, amount: float, tx_type: str, description: str):
@@ -667,17 +989,10 @@ class UserManager:
             
             # Record referral
             data_manager.referrals[referred_str] = str(referrer_id)
-            await Storage.save_referrals(data_manager.referrals)
+            data_manager.mark_referral_added(referred_str)
         
         # Update referrer's stats
-        referrer = await UserManager.get_user(referrer_id)
-        new_balance = referrer.get('balance', 0) + 1.0
-        
-        await UserManager.update_user(referrer_id, {
-            'balance': new_balance,
-            'referral_count': referrer.get('referral_count', 0) + 1,
-            'total_earned': referrer.get('total_earned', 0) + 1.0
-        })
+        await UserManager.add_balance(referrer_id, 1.0, increments={'referral_count': 1})
         
         # Add transaction
         await UserManager.add_transaction(
@@ -691,37 +1006,54 @@ class UserManager:
         return True
     
     @staticmethod
-    async def add_pending_referral(referrer_id: int, referred_id: int):
-        """Add pending referral (when user starts with referral link but hasn't joined channels yet)"""
-        await Storage.save_pending_referral(referrer_id, referred_id)
+    async def add_pending_referral(referrer_id: int, referred_id: int) -> bool:
+        """Add pending referral (when user starts with referral link but hasn't joined channels yet)
+        
+        Returns False if the user already has a pending referral."""
+        if pending_referrer_cache.get(referred_id) is not None:
+            return False
+        
+        if not await Storage.save_pending_referral(referrer_id, referred_id):
+            return False
+        
+        pending_referrer_cache.set(referred_id, referrer_id)
         logger.info(f"📝 Pending referral added: {referrer_id} → {referred_id}")
+        return True
     
     @staticmethod
     async def get_pending_referrer(referred_id: int) -> Optional[int]:
-        """Get pending referrer ID for a user"""
-        return await Storage.get_pending_referrer(referred_id)
+        """Get pending referrer ID for a user (cached, including misses)"""
+        cached = pending_referrer_cache.get(referred_id, CACHE_MISS)
+        if cached is not CACHE_MISS:
+            return cached
+        
+        referrer_id = await Storage.get_pending_referrer(referred_id)
+        pending_referrer_cache.set(referred_id, referrer_id)
+        return referrer_id
     
     @staticmethod
     async def remove_pending_referral(referred_id: int):
         """Remove pending referral"""
         await Storage.remove_pending_referral(referred_id)
+        pending_referrer_cache.set(referred_id, None)
         logger.info(f"🗑️ Pending referral removed for user {referred_id}")
     
     @staticmethod
     async def give_welcome_bonus(user_id: int) -> bool:
         """Give ₹1 welcome bonus to new user - returns True if bonus was given"""
+        user_str = str(user_id)
         user = await UserManager.get_user(user_id)
         
-        if user.get('welcome_bonus_received', False):
-            return False  # Already received welcome bonus
+        # Check and claim under the lock so concurrent updates can't pay twice
+        async with data_manager._async_lock():
+            user = data_manager.users.setdefault(user_str, user)
+            if user.get('welcome_bonus_received', False):
+                return False  # Already received welcome bonus
+            user['welcome_bonus_received'] = True
+            data_manager.mark_user_dirty(user_str)
         
         # Give welcome bonus
-        new_balance = user.get('balance', 0) + 1.0
-        await UserManager.update_user(user_id, {
-            'balance': new_balance,
-            'welcome_bonus_received': True,
-            'total_earned': user.get('total_earned', 0) + 1.0
-        })
+        await UserManager.add_balance(user_id, 1.0)
         
         # Add transaction
         await UserManager.add_transaction(
@@ -742,27 +1074,30 @@ async def check_channel_membership(bot, user_id: int) -> tuple:
         logger.info("No channels configured, skipping membership check")
         return True, []
     
-    tasks = []
-    not_joined = []
+    if joined_cache.get(user_id):
+        return True, []
     
-    for channel in channels:
-        task = asyncio.create_task(check_single_channel(bot, user_id, channel))
-        tasks.append(task)
+    not_joined = []
     
-    # Wait for all checks to complete with timeout
+    # Run all checks concurrently
     try:
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-        for i, result in enumerate(results):
+        results = await asyncio.gather(
+            *(check_single_channel(bot, user_id, channel) for channel in channels),
+            return_exceptions=True
+        )
+        for channel, result in zip(channels, results):
             if isinstance(result, Exception):
-                logger.error(f"Error checking channel {channels[i]['chat_id']}: {result}")
-                not_joined.append(channels[i])
+                logger.error(f"Error checking channel {channel['chat_id']}: {result}")
+                not_joined.append(channel)
             elif not result:
-                not_joined.append(channels[i])
+                not_joined.append(channel)
     except Exception as e:
         logger.error(f"Error in channel check: {e}")
         not_joined = channels  # Assume not joined on error
     
     logger.info(f"User {user_id} membership: joined={len(not_joined) == 0}, not_joined={len(not_joined)}")
+    if not not_joined:
+        joined_cache.set(user_id, True)
     return len(not_joined) == 0, not_joined
 
 async def check_single_channel(bot, user_id: int, channel: Dict) -> bool:
@@ -780,7 +1115,7 @@ async def check_single_channel(bot, user_id: int, channel: Dict) -> bool:
                 bot.get_chat_member(chat_id=chat_id_int, user_id=user_id),
                 timeout=10.0
             )
-            return member.status not in ['left', 'kicked']
+            return member.status not in NOT_MEMBER_STATUSES
         except asyncio.TimeoutError:
             logger.warning(f"Timeout checking {chat_id}")
             return False
@@ -792,6 +1127,18 @@ async def check_single_channel(bot, user_id: int, channel: Dict) -> bool:
         return False
 
 async def get_invite_link(bot, chat_id, channel_name: str = None):
+    """Get invite link for a chat, reusing a cached link when available"""
+    cache_key = str(chat_id)
+    invite_link = invite_link_cache.get(cache_key)
+    if invite_link:
+        return invite_link
+    
+    invite_link = await fetch_invite_link(bot, chat_id, channel_name)
+    if invite_link:
+        invite_link_cache.set(cache_key, invite_link)
+    return invite_link
+
+async def fetch_invite_link(bot, chat_id, channel_name: str = None):
     """Get or create invite link for a chat with timeout"""
     try:
         if isinstance(chat_id, str) and chat_id.lstrip('-').isdigit():
@@ -873,27 +1220,19 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         # Check for referral parameter - SILENTLY handle it
         args = context.args
-        if args and args[0].startswith('REF'):
+        if args and REFERRAL_CODE_RE.fullmatch(args[0]):
             referral_code = args[0]
             logger.info(f"Referral code detected: {referral_code}")
             
             # Skip if user was already referred
             if not UserManager.is_referred(user.id):
-                # Find referrer by code
-                referrer_found = None
-                async with data_manager._async_lock():
-                    for user_id_str, user_data_item in data_manager.users.items():
-                        if user_data_item.get('referral_code') == referral_code:
-                            referrer_found = int(user_id_str)
-                            break
+                # Find referrer by code (indexed lookup)
+                referrer_str = data_manager.referral_codes.get(referral_code)
+                referrer_found = int(referrer_str) if referrer_str else None
                 
                 if referrer_found and referrer_found != user.id:
-                    # Check if already has pending referral
-                    existing_pending = await UserManager.get_pending_referrer(user.id)
-                    
-                    if not existing_pending:
-                        # Store as PENDING referral (silently)
-                        await UserManager.add_pending_referral(referrer_found, user.id)
+                    # Store as PENDING referral (silently) unless one already exists
+                    if await UserManager.add_pending_referral(referrer_found, user.id):
                         logger.info(f"Silently recorded pending referral: {referrer_found} → {user.id}")
         
         # Check channel membership with timeout
@@ -934,11 +1273,11 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     await update.message.reply_text("🎉 You received ₹1 welcome bonus!")
                 
                 # Show main menu
-                await show_main_menu(update, context)
+                await show_main_menu(update, context, user_data)
                 
         except asyncio.TimeoutError:
             logger.warning(f"Timeout checking channels for user {user.id}")
-            await show_main_menu(update, context)
+            await show_main_menu(update, context, user_data)
             
     except Exception as e:
         logger.error(f"Error in start_command: {e}", exc_info=True)
@@ -1037,10 +1376,16 @@ async def verify_join_callback(update: Update, context: ContextTypes.DEFAULT_TYP
     """Handle verify join button callback - Show only welcome bonus notification"""
     try:
         query = update.callback_query
-        await query.answer()
-        
         user = update.effective_user
         
+        # Allow one verification per user every few seconds
+        if verify_throttle_cache.get(user.id):
+            await query.answer(f"⏳ Please wait {VERIFY_THROTTLE_SECONDS}s before checking again.")
+            return
+        verify_throttle_cache.set(user.id, True)
+        
+        await query.answer()
+        
         # Check membership with timeout
         try:
             has_joined, not_joined = await asyncio.wait_for(
@@ -1071,23 +1416,24 @@ async def verify_join_callback(update: Update, context: ContextTypes.DEFAULT_TYP
                     await query.message.reply_text("🎉 You received ₹1 welcome bonus!")
                 
                 # Just show main menu
-                await show_main_menu_callback(update, context)
+                await show_main_menu(update, context)
             else:
                 # Show updated join buttons
                 await show_join_buttons(update, context, not_joined)
                 
         except asyncio.TimeoutError:
-            await show_main_menu_callback(update, context)
+            await show_main_menu(update, context)
             
     except Exception as e:
         logger.error(f"Error in verify_join_callback: {e}")
-        await show_main_menu_callback(update, context)
+        await show_main_menu(update, context)
 
-async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Show main menu to user - Clean version"""
+async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, user_data: Optional[Dict] = None):
+    """Show main menu to user - Clean version (pass user_data if already loaded)"""
     try:
         user = update.effective_user
-        user_data = await UserManager.get_user(user.id)
+        if user_data is None:
+            user_data = await UserManager.get_user(user.id)
         
         message = (
             f"Welcome, {user.first_name}!\n\n"
@@ -1097,38 +1443,23 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"Your Referral Code: {user_data.get('referral_code', '')}"
         )
         
-        keyboard = [
-            [InlineKeyboardButton("💰 Balance", callback_data="balance"),
-             InlineKeyboardButton("📤 Withdraw", callback_data="withdraw")],
-            [InlineKeyboardButton("📜 History", callback_data="history"),
-             InlineKeyboardButton("👥 Referrals", callback_data="referrals")],
-            [InlineKeyboardButton("🔗 Invite Link", callback_data="invite_link")]
-        ]
-        
-        # Add admin button if user is admin
-        if user.id in ADMIN_IDS:
-            keyboard.append([InlineKeyboardButton("👑 Admin Panel", callback_data="admin_panel")])
-        
-        keyboard.append([InlineKeyboardButton("🔄 Refresh", callback_data="refresh")])
+        # Admins get the extra Admin Panel button
+        keyboard = MAIN_MENU_ADMIN_KB if user.id in ADMIN_IDS else MAIN_MENU_KB
         
         if update.callback_query:
             await update.callback_query.edit_message_text(
                 text=message,
-                reply_markup=InlineKeyboardMarkup(keyboard)
+                reply_markup=keyboard
             )
         else:
             await update.message.reply_text(
                 text=message,
-                reply_markup=InlineKeyboardMarkup(keyboard)
+                reply_markup=keyboard
             )
             
     except Exception as e:
         logger.error(f"Error in show_main_menu: {e}")
 
-async def show_main_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle main menu callback"""
-    await show_main_menu(update, context)
-
 async def balance_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle balance button callback"""
     try:
@@ -1147,14 +1478,9 @@ async def balance_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"Withdraw using: /withdraw <amount> <method>"
         )
         
-        keyboard = [
-            [InlineKeyboardButton("📤 Withdraw", callback_data="withdraw"),
-             InlineKeyboardButton("🔙 Back", callback_data="back_to_main")]
-        ]
-        
         await query.edit_message_text(
             text=message,
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=BALANCE_KB
         )
     except Exception as e:
         logger.error(f"Error in balance_callback: {e}")
@@ -1170,13 +1496,7 @@ async def withdraw_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Get command arguments
         args = context.args
         if not args or len(args) < 2:
-            await update.message.reply_text(
-                "Withdrawal Request\n\n"
-                "Usage: /withdraw <amount> <method>\n"
-                "Example: /withdraw 50 upi\n\n"
-                "Available methods: UPI, Bank Transfer\n"
-                "Minimum withdrawal: ₹10.00"
-            )
+            await update.message.reply_text(WITHDRAW_USAGE_TEXT)
             return
         
         try:
@@ -1187,21 +1507,14 @@ async def withdraw_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text("Minimum withdrawal amount is ₹10.00")
                 return
             
-            user_data = await UserManager.get_user(user.id)
+            # Check and deduct balance atomically
+            new_balance = await UserManager.withdraw_balance(user.id, amount)
             
-            if user_data.get('balance', 0) < amount:
+            if new_balance is None:
+                user_data = await UserManager.get_user(user.id)
                 await update.message.reply_text(f"Insufficient balance. You have ₹{user_data.get('balance', 0):.2f}")
                 return
             
-            # Update user balance
-            new_balance = user_data.get('balance', 0) - amount
-            total_withdrawn = user_data.get('total_withdrawn', 0) + amount
-            
-            await UserManager.update_user(user.id, {
-                'balance': new_balance,
-                'total_withdrawn': total_withdrawn
-            })
-            
             # Add transaction
             await UserManager.add_transaction(
                 user.id,
@@ -1219,11 +1532,15 @@ async def withdraw_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 f"New Balance: ₹{new_balance:.2f}"
             )
             
-            for admin_id in ADMIN_IDS:
-                try:
-                    await context.bot.send_message(chat_id=admin_id, text=admin_message)
-                except Exception as e:
-                    logger.error(f"Failed to notify admin {admin_id}: {e}")
+            # Notify all admins concurrently
+            admin_ids = list(ADMIN_IDS)
+            results = await asyncio.gather(
+                *(context.bot.send_message(chat_id=admin_id, text=admin_message) for admin_id in admin_ids),
+                return_exceptions=True
+            )
+            for admin_id, result in zip(admin_ids, results):
+                if isinstance(result, Exception):
+                    logger.error(f"Failed to notify admin {admin_id}: {result}")
             
             await update.message.reply_text(
                 f"Withdrawal Request Submitted!\n\n"
@@ -1258,14 +1575,9 @@ async def withdraw_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"Available methods: UPI, Bank Transfer"
         )
         
-        keyboard = [
-            [InlineKeyboardButton("💰 Check Balance", callback_data="balance"),
-             InlineKeyboardButton("🔙 Back", callback_data="back_to_main")]
-        ]
-        
         await query.edit_message_text(
             text=message,
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=WITHDRAW_KB
         )
     except Exception as e:
         logger.error(f"Error in withdraw_callback: {e}")
@@ -1293,13 +1605,9 @@ async def history_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             
             message = "Recent Transactions\n\n" + "\n".join(tx_list)
         
-        keyboard = [
-            [InlineKeyboardButton("🔙 Back", callback_data="back_to_main")]
-        ]
-        
         await query.edit_message_text(
             text=message,
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=BACK_TO_MAIN_KB
         )
     except Exception as e:
         logger.error(f"Error in history_callback: {e}")
@@ -1326,17 +1634,12 @@ async def referrals_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
             f"1. Share your referral link\n"
             f"2. When someone joins via your link AND joins all channels\n"
             f"3. You earn ₹1.00 per successful referral\n\n"
-            f"Share: https://t.me/{context.bot.username}?start={referral_code}"
+            f"Share: {referral_link_prefix}{referral_code}"
         )
         
-        keyboard = [
-            [InlineKeyboardButton("🔗 Share Link", callback_data="invite_link")],
-            [InlineKeyboardButton("🔙 Back", callback_data="back_to_main")]
-        ]
-        
         await query.edit_message_text(
             text=message,
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=REFERRALS_KB
         )
     except Exception as e:
         logger.error(f"Error in referrals_callback: {e}")
@@ -1351,7 +1654,7 @@ async def invite_link_callback(update: Update, context: ContextTypes.DEFAULT_TYP
         user_data = await UserManager.get_user(user.id)
         
         referral_code = user_data.get('referral_code', f"REF{user.id}")
-        invite_link = f"https://t.me/{context.bot.username}?start={referral_code}"
+        invite_link = referral_link_prefix + referral_code
         
         message = (
             f"Your Referral Link\n\n"
@@ -1375,19 +1678,7 @@ async def invite_link_callback(update: Update, context: ContextTypes.DEFAULT_TYP
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /help command"""
-    await update.message.reply_text(
-        "Bot Help\n\n"
-        "Available Commands:\n"
-        "/start - Start the bot\n"
-        "/withdraw <amount> <method> - Withdraw money\n"
-        "/help - Show this help\n\n"
-        "How to Earn:\n"
-        "1. Get ₹1 welcome bonus after joining all channels\n"
-        "2. Share your referral link\n"
-        "3. Earn ₹1.00 when someone joins via your link AND completes all channel joins\n"
-        "4. Minimum withdrawal: ₹10.00\n\n"
-        "Note: Referral bonuses are credited after users join all required channels!"
-    )
+    await update.message.reply_text(HELP_TEXT)
 
 async def restart_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /restart command (admin only)"""
@@ -1396,6 +1687,12 @@ async def restart_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Admin only")
         return
     
+    # execv skips post_shutdown and atexit, so write pending changes first
+    await data_manager.flush_dirty_data()
+    if data_manager._dirty_users or data_manager._new_referrals:
+        await update.message.reply_text("Restart cancelled - pending changes could not be saved. Try again shortly.")
+        return
+    
     await update.message.reply_text("Bot restarting...")
     os.execv(sys.executable, [sys.executable] + sys.argv)
 
@@ -1419,6 +1716,19 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     stats = data_manager.get_stats()
     await update.message.reply_text(stats, parse_mode=ParseMode.HTML)
 
+def chunk_lines(header: str, lines: List[str], limit: int = MESSAGE_CHUNK_SIZE) -> List[str]:
+    """Pack lines into messages of at most limit characters without splitting a line"""
+    chunks = []
+    current = header
+    for line in lines:
+        if current and len(current) + len(line) + 1 > limit:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n{line}" if current else line
+    if current:
+        chunks.append(current)
+    return chunks
+
 async def list_channels_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /listchannels command (admin only)"""
     user = update.effective_user
@@ -1428,15 +1738,16 @@ async def list_channels_command(update: Update, context: ContextTypes.DEFAULT_TY
     
     channels = ChannelManager.get_channels()
     if not channels:
-        message = "No channels configured"
-    else:
-        channel_list = []
-        for i, channel in enumerate(channels, 1):
-            channel_list.append(f"{i}. {channel.get('name', 'Channel')} - {channel.get('chat_id')}")
-        
-        message = f"Configured Channels ({len(channels)})\n\n" + "\n".join(channel_list)
+        await update.message.reply_text("No channels configured")
+        return
     
-    await update.message.reply_text(message)
+    channel_list = []
+    for i, channel in enumerate(channels, 1):
+        channel_list.append(f"{i}. {channel.get('name', 'Channel')} - {channel.get('chat_id')}")
+    
+    # Long channel lists go out as several messages - sent one by one to keep them in order
+    for chunk in chunk_lines(f"Configured Channels ({len(channels)})\n", channel_list):
+        await update.message.reply_text(chunk)
 
 async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /broadcast command (admin only)"""
@@ -1445,16 +1756,17 @@ async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Admin only")
         return
     
-    args = context.args
-    if not args:
+    # Take the raw text after the command - keeps the admin's line breaks and spacing
+    parts = update.message.text.split(maxsplit=1)
+    if len(parts) < 2:
         await update.message.reply_text("Usage: /broadcast <message>")
         return
     
-    message = " ".join(args)
+    message = parts[1]
     
     # Confirmation keyboard
     keyboard = [
-        [InlineKeyboardButton("✅ Confirm", callback_data=f"admin_broadcast_confirm_{message[:50]}"),
+        [InlineKeyboardButton("✅ Confirm", callback_data=f"{BROADCAST_CONFIRM_PREFIX}{message[:50]}"),
          InlineKeyboardButton("❌ Cancel", callback_data="admin_panel")]
     ]
     
@@ -1472,38 +1784,9 @@ async def admin_panel_callback(update: Update, context: ContextTypes.DEFAULT_TYP
         query = update.callback_query
         await query.answer()
         
-        user = update.effective_user
-        
-        if user.id not in ADMIN_IDS:
-            await query.answer("Admin only", show_alert=True)
-            return
-        
-        stats = data_manager.get_stats()
-        
-        message = (
-            f"👑 Admin Panel\n\n"
-            f"{stats}\n\n"
-            "Commands:\n"
-            "/listchannels - View channels (read-only)\n"
-            "/broadcast <message> - Broadcast\n"
-            "/restart - Restart options\n"
-            "/backup - Backup data\n"
-            "/stats - Show statistics\n\n"
-            "Channel Configuration:\n"
-            "Channels are configured via INITIAL_CHANNELS environment variable."
-        )
-        
-        keyboard = [
-            [InlineKeyboardButton("📢 View Channels", callback_data="admin_channels")],
-            [InlineKeyboardButton("📊 Stats", callback_data="admin_stats")],
-            [InlineKeyboardButton("💾 Backup", callback_data="admin_backup")],
-            [InlineKeyboardButton("🔄 Restart", callback_data="admin_restart")],
-            [InlineKeyboardButton("🔙 Back", callback_data="back_to_main")]
-        ]
-        
         await query.edit_message_text(
-            text=message,
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            text=ADMIN_PANEL_TEXT.format(stats=data_manager.get_stats()),
+            reply_markup=ADMIN_PANEL_KB
         )
     except Exception as e:
         logger.error(f"Error in admin_panel_callback: {e}")
@@ -1514,11 +1797,6 @@ async def admin_channels_callback(update: Update, context: ContextTypes.DEFAULT_
         query = update.callback_query
         await query.answer()
         
-        user = update.effective_user
-        if user.id not in ADMIN_IDS:
-            await query.answer("Admin only", show_alert=True)
-            return
-        
         channels = ChannelManager.get_channels()
         
         if not channels:
@@ -1531,17 +1809,49 @@ async def admin_channels_callback(update: Update, context: ContextTypes.DEFAULT_
             
             message = f"Configured Channels ({len(channels)})\n\n" + "\n".join(channel_list)
         
-        keyboard = [
-            [InlineKeyboardButton("🔙 Back", callback_data="admin_panel")]
-        ]
-        
         await query.edit_message_text(
             text=message,
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=BACK_TO_ADMIN_KB
         )
     except Exception as e:
         logger.error(f"Error in admin_channels_callback: {e}")
 
+async def admin_broadcast_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, message: str):
+    """Handle broadcast confirmation - message is already parsed from the callback data"""
+    query = update.callback_query
+    await query.answer()
+    
+    if message.endswith("..."):
+        await query.edit_message_text("Message too long, please send shorter broadcast.")
+        return
+    
+    await query.edit_message_text("Broadcasting to users...")
+    
+    text = f"Broadcast Message\n\n{message}"
+    # Snapshot the ids - new users may register while the broadcast is running
+    user_ids = list(data_manager.users)
+    success = 0
+    
+    # Send in concurrent batches, one batch per second, to stay under Telegram's global rate limit
+    for i in range(0, len(user_ids), BROADCAST_BATCH_SIZE):
+        batch = user_ids[i:i + BROADCAST_BATCH_SIZE]
+        results = await asyncio.gather(
+            *(context.bot.send_message(chat_id=int(user_id_str), text=text) for user_id_str in batch),
+            return_exceptions=True
+        )
+        success += sum(1 for result in results if not isinstance(result, Exception))
+        if i + BROADCAST_BATCH_SIZE < len(user_ids):
+            await asyncio.sleep(1)
+    
+    failed = len(user_ids) - success
+    
+    await query.edit_message_text(
+        f"Broadcast Complete\n\n"
+        f"Successful: {success}\n"
+        f"Failed: {failed}\n"
+        f"Total: {success + failed} users"
+    )
+
 async def admin_handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle admin callback queries"""
     query = update.callback_query
@@ -1549,36 +1859,7 @@ async def admin_handle_callback(update: Update, context: ContextTypes.DEFAULT_TY
     
     data = query.data
     
-    if data.startswith("admin_broadcast_confirm_"):
-        message = data.replace("admin_broadcast_confirm_", "")
-        
-        if message.endswith("..."):
-            await query.edit_message_text("Message too long, please send shorter broadcast.")
-            return
-        
-        await query.edit_message_text("Broadcasting to users...")
-        
-        success = 0
-        failed = 0
-        
-        for user_id_str in data_manager.users:
-            try:
-                await context.bot.send_message(
-                    chat_id=int(user_id_str),
-                    text=f"Broadcast Message\n\n{message}"
-                )
-                success += 1
-            except:
-                failed += 1
-        
-        await query.edit_message_text(
-            f"Broadcast Complete\n\n"
-            f"Successful: {success}\n"
-            f"Failed: {failed}\n"
-            f"Total: {success + failed} users"
-        )
-    
-    elif data == "admin_stats":
+    if data == "admin_stats":
         stats = data_manager.get_stats()
         await query.edit_message_text(stats, parse_mode=ParseMode.HTML)
     
@@ -1587,21 +1868,15 @@ async def admin_handle_callback(update: Update, context: ContextTypes.DEFAULT_TY
         await query.edit_message_text("Data backed up successfully")
     
     elif data == "admin_restart":
-        keyboard = [
-            [InlineKeyboardButton("🔄 Soft Restart", callback_data="admin_restart_soft"),
-             InlineKeyboardButton("🔙 Cancel", callback_data="admin_panel")]
-        ]
         await query.edit_message_text(
-            "Restart Options\n\n"
-            "Soft Restart: Reload data without stopping bot",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            RESTART_OPTIONS_TEXT,
+            reply_markup=ADMIN_RESTART_KB
         )
     elif data == "admin_restart_soft":
-        data_manager._load_all_data_sync()
-        await query.edit_message_text("Data reloaded successfully")
-    
-    elif data == "admin_panel":
-        await admin_panel_callback(update, context)
+        if await data_manager.reload_all_data_async():
+            await query.edit_message_text("Data reloaded successfully")
+        else:
+            await query.edit_message_text("Reload skipped - pending changes could not be saved. Try again shortly.")
 
 async def confirm_reset_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle confirm reset callback"""
@@ -1623,6 +1898,180 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         except:
             pass
 
+# Commands shown in the Telegram command menu
+USER_COMMANDS = (
+    BotCommand("start", "Start the bot"),
+    BotCommand("withdraw", "Withdraw money"),
+    BotCommand("help", "Show help"),
+)
+ADMIN_COMMANDS = USER_COMMANDS + (
+    BotCommand("listchannels", "View configured channels"),
+    BotCommand("broadcast", "Broadcast a message"),
+    BotCommand("stats", "Show statistics"),
+    BotCommand("backup", "Backup data"),
+    BotCommand("restart", "Restart the bot"),
+)
+COMMANDS_STATE_FILE = 'bot_commands_state.json'
+
+async def set_commands(application: Application):
+    """Push the command menus to Telegram only when they have changed since the last push"""
+    commands_hash = hashlib.sha1(repr((
+        application.bot.id,
+        sorted(ADMIN_IDS),
+        [(c.command, c.description) for c in USER_COMMANDS],
+        [(c.command, c.description) for c in ADMIN_COMMANDS]
+    )).encode()).hexdigest()
+    
+    # The file holds the last published hash and the admin ids that got the admin menu
+    published = {}
+    try:
+        if os.path.exists(COMMANDS_STATE_FILE):
+            with open(COMMANDS_STATE_FILE, 'r') as f:
+                published = json.load(f)
+        if not isinstance(published, dict):
+            published = {}
+    except Exception as e:
+        logger.warning(f"Could not read commands state: {e}")
+    
+    if published.get('hash') == commands_hash:
+        logger.info("Bot commands unchanged, skipping set_my_commands")
+        return
+    
+    try:
+        await application.bot.set_my_commands(USER_COMMANDS, scope=BotCommandScopeDefault())
+    except Exception as e:
+        logger.error(f"Failed to set bot commands: {e}")
+        return
+    
+    all_set = True
+    for admin_id in ADMIN_IDS:
+        try:
+            await application.bot.set_my_commands(ADMIN_COMMANDS, scope=BotCommandScopeChat(admin_id))
+        except Exception as e:
+            # Fails if the admin has never started the bot - retry on next start
+            logger.warning(f"Failed to set admin commands for {admin_id}: {e}")
+            all_set = False
+    
+    # Admins removed from ADMIN_IDS would otherwise keep their admin menu
+    for admin_id in set(published.get('admin_ids', [])) - ADMIN_IDS:
+        try:
+            await application.bot.delete_my_commands(scope=BotCommandScopeChat(admin_id))
+        except Exception as e:
+            logger.warning(f"Failed to remove admin commands for {admin_id}: {e}")
+            all_set = False
+    
+    if not all_set:
+        # Leave the stored state alone so the failed admin scopes are retried on next start
+        logger.warning("⚠️ Bot commands partially updated - some admin menus failed")
+        return
+    
+    try:
+        with open(COMMANDS_STATE_FILE, 'w') as f:
+            json.dump({'hash': commands_hash, 'admin_ids': sorted(ADMIN_IDS)}, f)
+    except Exception as e:
+        logger.warning(f"Could not write commands state: {e}")
+    logger.info("✅ Bot commands updated")
+
+# "https://t.me/<bot>?start=" - set in post_init once the bot username is known
+referral_link_prefix = ""
+
+# Seconds between flushes of changed users/referrals to storage
+FLUSH_INTERVAL = 0.5
+flush_task: Optional[asyncio.Task] = None
+flush_stop: Optional[asyncio.Event] = None
+
+async def flush_loop():
+    """Background task - write batched user/referral changes to storage until flush_stop is set"""
+    while not flush_stop.is_set():
+        try:
+            await asyncio.wait_for(flush_stop.wait(), timeout=FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        try:
+            await data_manager.flush_dirty_data()
+        except Exception as e:
+            logger.error(f"Error flushing data: {e}")
+
+async def post_init(application: Application):
+    """Run once the application is initialized, inside the event loop"""
+    global flush_task, flush_stop, referral_link_prefix
+    # Bot info is fetched by initialize(), so the username is available without an API call
+    referral_link_prefix = f"https://t.me/{application.bot.username}?start="
+    logger.info(f"🤖 Bot username: @{application.bot.username}")
+    
+    await set_commands(application)
+    flush_stop = asyncio.Event()
+    flush_task = asyncio.create_task(flush_loop())
+
+async def post_shutdown(application: Application):
+    """Stop the flush task and write any pending changes"""
+    if flush_task:
+        # Never cancel mid-flush: a cancelled wait on the data lock still leaves the
+        # executor thread holding it. Let the current iteration finish instead.
+        flush_stop.set()
+        await flush_task
+    await data_manager.flush_dirty_data()
+
+# Callback dispatch table - exact callback_data matches
+CALLBACK_ROUTES = {
+    "verify_join": verify_join_callback,
+    "no_invite_link": no_invite_link_callback,
+    "back_to_main": show_main_menu,
+    "refresh": show_main_menu,
+    "balance": balance_callback,
+    "withdraw": withdraw_callback,
+    "history": history_callback,
+    "referrals": referrals_callback,
+    "invite_link": invite_link_callback,
+    "admin_panel": admin_panel_callback,
+    "admin_channels": admin_channels_callback,
+    "confirm_reset": confirm_reset_callback,
+}
+
+async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Route callback queries with one dict lookup instead of per-handler regex checks"""
+    query = update.callback_query
+    data = query.data or ""
+    
+    # Every admin_ button is checked here, before any handler answers the query
+    if data.startswith("admin_") and update.effective_user.id not in ADMIN_IDS:
+        await query.answer("Admin only", show_alert=True)
+        return
+    
+    handler = CALLBACK_ROUTES.get(data)
+    if handler is None:
+        # Broadcast confirmation carries its payload - parse it once here
+        if data.startswith(BROADCAST_CONFIRM_PREFIX):
+            await admin_broadcast_callback(update, context, data[len(BROADCAST_CONFIRM_PREFIX):])
+            return
+        # Other prefixed admin actions (admin_stats, admin_backup, ...)
+        if data.startswith("admin_"):
+            handler = admin_handle_callback
+        else:
+            return
+    
+    await handler(update, context)
+
+# All update handlers, registered in one call from main(). Kept in a single group
+# so an update stops at its first matching handler; the callback router comes first
+# because button presses are the most frequent update type.
+HANDLERS = [
+    # Callback handler - single entry point, dispatched via CALLBACK_ROUTES
+    CallbackQueryHandler(callback_router),
+    
+    # User commands
+    CommandHandler("start", start_command),
+    CommandHandler("withdraw", withdraw_command),
+    CommandHandler("help", help_command),
+    
+    # Admin commands (read-only for channels)
+    CommandHandler("restart", restart_command),
+    CommandHandler("backup", backup_command),
+    CommandHandler("stats", stats_command),
+    CommandHandler("listchannels", list_channels_command),
+    CommandHandler("broadcast", broadcast_command),
+]
+
 # Simple HTTP server for Render
 def run_http_server():
     """Run HTTP server for health checks"""
@@ -1648,11 +2097,17 @@ def run_http_server():
 
 def main():
     """Main function to start the bot"""
+    global db_connected, data_manager
+    
     if not BOT_TOKEN:
         logger.error("❌ BOT_TOKEN not set")
         print("ERROR: Please set BOT_TOKEN environment variable")
         return
     
+    # Initialize database and load data
+    db_connected = init_database()
+    data_manager = DataManager()
+    
     # Check MongoDB URI for common issues
     if MONGODB_URI and "mongodb+srv://" in MONGODB_URI:
         logger.info("ℹ️ Using MongoDB SRV connection - make sure DNS is properly configured")
@@ -1669,53 +2124,24 @@ def main():
         .read_timeout(30.0)
         .write_timeout(30.0)
         .pool_timeout(30.0)
+        .connection_pool_size(256)  # Same as PTB 20's default - pinned so concurrent sends keep their headroom
+        .concurrent_updates(True)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
         .build()
     )
     
     # Add error handler
     application.add_error_handler(error_handler)
     
-    # Add command handlers
-    application.add_handler(CommandHandler("start", start_command))
-    application.add_handler(CommandHandler("withdraw", withdraw_command))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("restart", restart_command))
-    application.add_handler(CommandHandler("backup", backup_command))
-    application.add_handler(CommandHandler("stats", stats_command))
-    
-    # Admin commands (read-only for channels)
-    application.add_handler(CommandHandler("listchannels", list_channels_command))
-    application.add_handler(CommandHandler("broadcast", broadcast_command))
-    
-    # Callback handlers
-    application.add_handler(CallbackQueryHandler(verify_join_callback, pattern="^verify_join$"))
-    application.add_handler(CallbackQueryHandler(no_invite_link_callback, pattern="^no_invite_link$"))
-    application.add_handler(CallbackQueryHandler(show_main_menu_callback, pattern="^back_to_main$"))
-    application.add_handler(CallbackQueryHandler(show_main_menu_callback, pattern="^refresh$"))
-    application.add_handler(CallbackQueryHandler(balance_callback, pattern="^balance$"))
-    application.add_handler(CallbackQueryHandler(withdraw_callback, pattern="^withdraw$"))
-    application.add_handler(CallbackQueryHandler(history_callback, pattern="^history$"))
-    application.add_handler(CallbackQueryHandler(referrals_callback, pattern="^referrals$"))
-    application.add_handler(CallbackQueryHandler(invite_link_callback, pattern="^invite_link$"))
-    application.add_handler(CallbackQueryHandler(admin_panel_callback, pattern="^admin_panel$"))
-    application.add_handler(CallbackQueryHandler(admin_channels_callback, pattern="^admin_channels$"))
-    application.add_handler(CallbackQueryHandler(admin_handle_callback, pattern="^admin_"))
-    application.add_handler(CallbackQueryHandler(confirm_reset_callback, pattern="^confirm_reset$"))
-    
-    # Try to get bot info
-    try:
-        bot_info = application.bot.get_me()
-        bot_username = bot_info.username
-    except Exception as e:
-        logger.warning(f"Could not fetch bot username: {e}")
-        bot_username = "unknown"
+    # Register all handlers in one call
+    application.add_handlers(HANDLERS)
     
     # Start bot
     logger.info("🤖 Bot is starting...")
     print("=" * 50)
     print(f"✅ Bot started successfully!")
-    print(f"🤖 Bot username: @{bot_username}")
-    print(f"👑 Admin IDs: {ADMIN_IDS}")
+    print(f"👑 Admin IDs: {sorted(ADMIN_IDS)}")
     print(f"📢 Channels configured: {len(data_manager.channels)}")
     if data_manager.channels:
         for i, channel in enumerate(data_manager.channels, 1):